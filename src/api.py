@@ -5,20 +5,34 @@ Provides endpoints for Excel analysis, room type optimization, and energy calcul
 
 import asyncio
 import base64
+import contextlib
+import hashlib
 import io
 import os
 import uuid
-import importlib.util
-from datetime import datetime
+from collections import OrderedDict
+import zipfile
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Optional, List
-import tempfile
-import shutil
+from types import MappingProxyType
+from typing import Awaitable, Callable, Dict, Optional, List, Tuple
+import threading
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse, Response
+import anyio
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import redis.asyncio as aioredis
+import xlsxwriter
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, FastAPI, File, UploadFile, HTTPException, Form, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 
@@ -32,22 +46,13 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 from src.power.merge_excel_files import merge_heating_ventilation_excel
 from src.roomtypes.service import process as process_roomtypes
 from src.roomtypes.models import Cfg
-
-# Import power estimator (using importlib due to hyphen in filename)
-import importlib.util
-spec = importlib.util.spec_from_file_location(
-    "power_estimator",
-    Path(__file__).parent / "power" / "power-estimator.py"
-)
-power_estimator = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(power_estimator)
-test_cost_analysis = power_estimator.test_cost_analysis
+from src.power.power_estimator import DEFAULT_CONTEXT_PATH as POWER_CONTEXT_PATH, ROOM_TYPES, test_cost_analysis
 
 # ==================== Models ====================
 
 class KeyChange(BaseModel):
     """Room type change"""
-    model_config = ConfigDict(populate_by_name=True)
+    model_config = ConfigDict(populate_by_name=True, frozen=True, extra='forbid')
     
     from_type: str = Field(..., alias="from")
     to: str
@@ -56,6 +61,8 @@ class KeyChange(BaseModel):
 
 class Step1Details(BaseModel):
     """Step 1 detailed metrics"""
+    model_config = ConfigDict(frozen=True, extra='forbid')
+    
     originalRoomTypesCount: Optional[int] = None
     optimizedRoomTypesCount: Optional[int] = None
     avgRoomSizeM2: Optional[float] = None
@@ -65,6 +72,8 @@ class Step1Details(BaseModel):
 
 class Step1Data(BaseModel):
     """Step 1 core metrics"""
+    model_config = ConfigDict(frozen=True, extra='forbid')
+    
     optimizedRooms: int
     totalRooms: int
     improvementRate: float
@@ -73,7 +82,10 @@ class Step1Data(BaseModel):
 
 class Step1Response(BaseModel):
     """Step 1 response with analysis results"""
+    model_config = ConfigDict(frozen=True, extra='forbid')
+    
     analysisId: str
+    processedExcelUrl: Optional[str] = None
     processedExcelBase64: Optional[str] = None
     processedExcelFilename: Optional[str] = None
     step1: Step1Data
@@ -84,10 +96,13 @@ class Step2Request(BaseModel):
     """Step 2 request"""
     analysisId: str
     parameters: Optional[Dict] = None
+    background: bool = False
 
 
 class RoomTypeBreakdown(BaseModel):
     """Room type energy breakdown"""
+    model_config = ConfigDict(frozen=True, extra='forbid')
+    
     roomType: str
     wPerM2: float
     sharePercent: Optional[float] = None
@@ -95,6 +110,8 @@ class RoomTypeBreakdown(BaseModel):
 
 class Step2Details(BaseModel):
     """Step 2 detailed metrics"""
+    model_config = ConfigDict(frozen=True, extra='forbid')
+    
     heatingPowerKw: Optional[float] = None
     annualConsumptionKwh: Optional[float] = None
     savingsKwh: Optional[float] = None
@@ -103,6 +120,8 @@ class Step2Details(BaseModel):
 
 class Step2Data(BaseModel):
     """Step 2 core metrics"""
+    model_config = ConfigDict(frozen=True, extra='forbid')
+    
     energyConsumption: float
     reductionPercentage: float
     annualSavings: float
@@ -110,40 +129,296 @@ class Step2Data(BaseModel):
 
 class Step2Response(BaseModel):
     """Step 2 response"""
+    model_config = ConfigDict(frozen=True, extra='forbid')
+    
     step2: Step2Data
     details: Optional[Step2Details] = None
 
 
-# ==================== In-Memory Storage (replace with Redis/DB for production) ====================
+# Serialize responses once; the JSON-ready dicts are both stored and returned
+STEP1_RESPONSE_ADAPTER = TypeAdapter(Step1Response)
+STEP2_RESPONSE_ADAPTER = TypeAdapter(Step2Response)
+
+
+def dump_response(adapter: TypeAdapter, response: BaseModel) -> Dict:
+    """Dump a response model to JSON-ready data, using field aliases"""
+    return adapter.dump_python(response, mode="json", by_alias=True)
+
+
+def step1_json_response(response: Dict, excel_size: Optional[int]) -> ORJSONResponse:
+    """Send a step 1 response with the merged Excel file's size as a header"""
+    headers = {EXCEL_SIZE_HEADER: str(excel_size)} if excel_size is not None else None
+    return ORJSONResponse(response, headers=headers)
+
+
+# ==================== Storage (in-memory, or Redis when REDIS_URL is set) ====================
+
+# orjson handles numpy scalars and non-str dict keys natively
+STORE_JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def _store_json_default(obj):
+    """Serialize values orjson doesn't know about natively"""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json", by_alias=True)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def encode_store_json(data) -> bytes:
+    """Encode analysis metadata for the Redis store backend"""
+    return orjson.dumps(data, default=_store_json_default, option=STORE_JSON_OPTIONS)
+
+
+def decode_store_json(raw: bytes):
+    """Decode analysis metadata written by encode_store_json"""
+    return orjson.loads(raw)
+
 
 class AnalysisStore:
-    """Simple in-memory store for analysis data"""
+    """In-memory store for analysis data, bounded by size and age.
+    
+    Entries live in TTL caches sharded by analysis ID, each with its own lock,
+    so concurrent reads don't contend on a single global lock. The size bound
+    is global: once maxsize analyses are stored, saving another evicts the
+    least recently saved one, whichever shard it is in.
+    """
     
-    def __init__(self):
-        self._data: Dict[str, Dict] = {}
+    def __init__(self, maxsize: int = 512, ttl: float = 3600, shards: int = 16):
+        # Each shard could hold everything; eviction is driven by _saved below
+        self._shards = [TTLCache(maxsize=maxsize, ttl=ttl) for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._maxsize = maxsize
+        # Analysis IDs from least to most recently saved. Expired IDs are always
+        # the oldest, so trimming from the front drops them before live analyses.
+        self._saved: OrderedDict = OrderedDict()
+        self._saved_lock = threading.Lock()
+        # Progress is kept apart from the records so updates don't rewrite them
+        self._progress = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._progress_lock = threading.Lock()
     
-    def save(self, analysis_id: str, data: Dict):
+    def _shard(self, analysis_id: str):
+        index = hash(analysis_id) % len(self._shards)
+        return self._shards[index], self._locks[index]
+    
+    def _encode(self, data: Dict):
+        """Convert a record for storage (identity for the in-process store)"""
+        return data
+    
+    def _decode(self, raw) -> Optional[Dict]:
+        """Convert a stored record back (identity for the in-process store)"""
+        return raw
+    
+    async def save(self, analysis_id: str, data: Dict):
         """Save analysis data"""
-        self._data[analysis_id] = {
+        record = self._encode({
             **data,
-            "created_at": datetime.now().isoformat(),
-        }
+            "created_at": now_iso(),
+        })
+        cache, lock = self._shard(analysis_id)
+        with lock:
+            cache[analysis_id] = record
+        
+        with self._saved_lock:
+            self._saved[analysis_id] = None
+            self._saved.move_to_end(analysis_id)
+            while len(self._saved) > self._maxsize:
+                oldest, _ = self._saved.popitem(last=False)
+                self._evict(oldest)
     
-    def get(self, analysis_id: str) -> Optional[Dict]:
+    def _evict(self, analysis_id: str):
+        """Drop an analysis and its progress from the in-memory caches"""
+        cache, lock = self._shard(analysis_id)
+        with lock:
+            cache.pop(analysis_id, None)
+        with self._progress_lock:
+            self._progress.pop(analysis_id, None)
+    
+    async def get(self, analysis_id: str) -> Optional[Dict]:
         """Get analysis data"""
-        return self._data.get(analysis_id)
+        cache, lock = self._shard(analysis_id)
+        with lock:
+            raw = cache.get(analysis_id)
+        return self._decode(raw) if raw is not None else None
     
-    def exists(self, analysis_id: str) -> bool:
+    async def exists(self, analysis_id: str) -> bool:
         """Check if analysis exists"""
-        return analysis_id in self._data
+        cache, lock = self._shard(analysis_id)
+        with lock:
+            return analysis_id in cache
     
-    def delete(self, analysis_id: str):
+    async def delete(self, analysis_id: str):
         """Delete analysis data"""
-        if analysis_id in self._data:
-            del self._data[analysis_id]
+        with self._saved_lock:
+            self._saved.pop(analysis_id, None)
+        self._evict(analysis_id)
+    
+    async def set_progress(self, analysis_id: str, step: str, percent: int):
+        """Record how far the running step of an analysis has got"""
+        with self._progress_lock:
+            self._progress[analysis_id] = {"step": step, "percent": percent}
+    
+    async def get_progress(self, analysis_id: str) -> Optional[Dict]:
+        """Get the last recorded progress of an analysis"""
+        with self._progress_lock:
+            return self._progress.get(analysis_id)
+    
+    async def get_meta(self, analysis_id: str) -> Tuple[Optional[Dict], Optional[Dict]]:
+        """Get an analysis without its binary payloads (if the backend can skip
+        them), together with its progress"""
+        return await self.get(analysis_id), await self.get_progress(analysis_id)
+    
+    async def get_excel(self, analysis_id: str) -> Optional[Tuple[bytes, str]]:
+        """Get the merged Excel file of an analysis and its filename"""
+        data = await self.get(analysis_id)
+        if not data or "excel_bytes" not in data:
+            return None
+        return data["excel_bytes"], data["excel_filename"]
+    
+    async def count(self) -> int:
+        """Number of stored analyses"""
+        return sum(len(cache) for cache in self._shards)
+    
+    def expire(self):
+        """Evict expired entries from every shard"""
+        for cache, lock in zip(self._shards, self._locks):
+            with lock:
+                cache.expire()
+        with self._progress_lock:
+            self._progress.expire()
+    
+    async def close(self):
+        """Release backend resources"""
 
 
-analysis_store = AnalysisStore()
+class RedisAnalysisStore(AnalysisStore):
+    """Redis-backed store, shared by all workers.
+    
+    Binary payloads (Parquet DataFrame, Excel file) are stored as raw bytes
+    under their own keys; the remaining metadata is stored as one JSON value.
+    All keys of an analysis share the same TTL.
+    """
+    
+    BINARY_FIELDS = ("slim_df_parquet", "excel_bytes")
+    
+    def __init__(self, url: str, ttl: int = 3600):
+        self._redis = aioredis.Redis.from_url(url)
+        self._ttl = ttl
+    
+    @staticmethod
+    def _key(analysis_id: str, part: str) -> str:
+        return f"analysis:{analysis_id}:{part}"
+    
+    def _encode(self, data: Dict) -> Dict[str, bytes]:
+        """Split a record into per-key values"""
+        meta = {k: v for k, v in data.items() if k not in self.BINARY_FIELDS}
+        values = {"meta": encode_store_json(meta)}
+        values.update({k: data[k] for k in self.BINARY_FIELDS if k in data})
+        return values
+    
+    def _decode(self, values: Dict[str, Optional[bytes]]) -> Optional[Dict]:
+        """Reassemble a record from per-key values"""
+        if values.get("meta") is None:
+            return None
+        data = decode_store_json(values["meta"])
+        data.update({k: v for k, v in values.items() if k != "meta" and v is not None})
+        return data
+    
+    async def save(self, analysis_id: str, data: Dict):
+        """Save analysis data"""
+        values = self._encode({
+            **data,
+            "created_at": now_iso(),
+        })
+        async with self._redis.pipeline(transaction=True) as pipe:
+            # Drop binary parts that are no longer part of the record
+            stale = [self._key(analysis_id, k) for k in self.BINARY_FIELDS if k not in values]
+            if stale:
+                pipe.delete(*stale)
+            for part, value in values.items():
+                pipe.set(self._key(analysis_id, part), value, ex=self._ttl)
+            await pipe.execute()
+    
+    async def get(self, analysis_id: str) -> Optional[Dict]:
+        """Get analysis data"""
+        parts = ("meta", *self.BINARY_FIELDS)
+        raw = await self._redis.mget([self._key(analysis_id, part) for part in parts])
+        return self._decode(dict(zip(parts, raw)))
+    
+    async def exists(self, analysis_id: str) -> bool:
+        """Check if analysis exists"""
+        return await self._redis.exists(self._key(analysis_id, "meta")) > 0
+    
+    async def get_meta(self, analysis_id: str) -> Tuple[Optional[Dict], Optional[Dict]]:
+        """Get the metadata and progress of an analysis in one round trip,
+        without the Parquet and Excel payloads"""
+        raw_meta, raw_progress = await self._redis.mget([
+            self._key(analysis_id, "meta"),
+            self._key(analysis_id, "progress"),
+        ])
+        return (
+            decode_store_json(raw_meta) if raw_meta is not None else None,
+            decode_store_json(raw_progress) if raw_progress is not None else None,
+        )
+    
+    async def delete(self, analysis_id: str):
+        """Delete analysis data"""
+        await self._redis.delete(*(self._key(analysis_id, part) for part in ("meta", "progress", *self.BINARY_FIELDS)))
+    
+    async def set_progress(self, analysis_id: str, step: str, percent: int):
+        """Record how far the running step of an analysis has got"""
+        await self._redis.set(
+            self._key(analysis_id, "progress"),
+            encode_store_json({"step": step, "percent": percent}),
+            ex=self._ttl,
+        )
+    
+    async def get_progress(self, analysis_id: str) -> Optional[Dict]:
+        """Get the last recorded progress of an analysis"""
+        raw = await self._redis.get(self._key(analysis_id, "progress"))
+        return decode_store_json(raw) if raw is not None else None
+    
+    async def get_excel(self, analysis_id: str) -> Optional[Tuple[bytes, str]]:
+        """Get the merged Excel file of an analysis and its filename (skips the DataFrame)"""
+        raw_meta, excel_bytes = await self._redis.mget([
+            self._key(analysis_id, "meta"),
+            self._key(analysis_id, "excel_bytes"),
+        ])
+        if raw_meta is None or excel_bytes is None:
+            return None
+        return excel_bytes, decode_store_json(raw_meta)["excel_filename"]
+    
+    async def count(self) -> int:
+        """Number of stored analyses"""
+        return sum([1 async for _ in self._redis.scan_iter(match=self._key("*", "meta"))])
+    
+    def expire(self):
+        """Redis expires keys itself"""
+    
+    async def close(self):
+        """Close the Redis connection pool"""
+        await self._redis.aclose()
+
+
+REDIS_URL = os.getenv("REDIS_URL")
+STORE_MAX = int(os.getenv("STORE_MAX", "512"))  # In-memory store only; Redis bounds memory itself
+STORE_TTL = int(os.getenv("STORE_TTL", "3600"))  # Seconds an analysis is kept
+MERGE_CACHE_MAX = int(os.getenv("MERGE_CACHE_MAX", "8"))  # Full merged frames kept for re-uploads (0 disables)
+
+if REDIS_URL:
+    analysis_store = RedisAnalysisStore(REDIS_URL, ttl=STORE_TTL)
+else:
+    analysis_store = AnalysisStore(maxsize=STORE_MAX, ttl=STORE_TTL)
+
+STORE_EXPIRE_INTERVAL_SECONDS = 60
+
+
+async def expire_caches_periodically():
+    """Evict expired analyses and merge results even when nobody reads them"""
+    while True:
+        await asyncio.sleep(STORE_EXPIRE_INTERVAL_SECONDS)
+        analysis_store.expire()
+        with merge_cache_lock:
+            merge_cache.expire()
 
 # ==================== Configuration ====================
 
@@ -154,6 +429,15 @@ class Config:
     PORT: int = int(os.getenv("PORT", "10000"))  # Render uses PORT env var
     HOST: str = os.getenv("HOST", "0.0.0.0")
     RELOAD: bool = os.getenv("RELOAD", "false").lower() == "true"  # Disable reload in production
+    FRONTEND_URL: str = os.getenv("FRONTEND_URL", "*")  # Add your frontend URL as env var
+    WEB_CONCURRENCY: int = int(os.getenv("WEB_CONCURRENCY", "1"))  # Uvicorn worker processes
+    MAX_CONCURRENT_ANALYSES: int = int(os.getenv("MAX_CONCURRENT_ANALYSES", "2"))
+    MAX_QUEUED_ANALYSES: int = int(os.getenv("MAX_QUEUED_ANALYSES", "8"))
+    CORS_ORIGINS: List[str] = [
+        "http://localhost:3000",
+        "http://localhost:5173",
+        FRONTEND_URL,
+    ]
     
     @classmethod
     def validate(cls):
@@ -178,24 +462,29 @@ app = FastAPI(
     title="BKW Hackathon API",
     description="Building energy analysis and optimization API",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
+# Step 1 responses report the merged Excel file's size here, so clients can
+# show it without downloading the file or requesting it inline
+EXCEL_SIZE_HEADER = "X-Excel-Size"
+
 # CORS middleware - UPDATE for production
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "http://localhost:3000",
-        "http://localhost:5173",
-        os.getenv("FRONTEND_URL", "*")  # Add your frontend URL as env var
-    ],
+    allow_origins=config.CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],  # The only methods the API exposes
+    allow_headers=["Content-Type", "Authorization"],
+    expose_headers=[EXCEL_SIZE_HEADER],  # Readable by browser clients
 )
 
 
 # ==================== Startup Event ====================
 
+_store_expiry_task: Optional[asyncio.Task] = None
+
+
 @app.on_event("startup")
 async def startup_event():
     """Validate configuration on startup"""
@@ -203,75 +492,299 @@ async def startup_event():
     print("🚀 BKW Hackathon API Starting...")
     print("=" * 60)
     config.validate()
+    
+    # Each worker process has its own in-memory store, so analyses would be
+    # found only by the worker that created them
+    if config.WEB_CONCURRENCY > 1 and not REDIS_URL:
+        raise RuntimeError(
+            f"WEB_CONCURRENCY={config.WEB_CONCURRENCY} requires REDIS_URL: "
+            "workers can only share analyses through Redis"
+        )
+    
+    # Excel serialization and metric calculation run in the default threadpool;
+    # handlers stay `async def` so the event loop is never blocked by them
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(32, (os.cpu_count() or 1) * 4)
+    print(f"🧵 Worker threads: {limiter.total_tokens}")
+    
+    global _store_expiry_task
+    _store_expiry_task = asyncio.create_task(expire_caches_periodically())
     print(f"📍 Server: http://{config.HOST}:{config.PORT}")
     print(f"📚 API Docs: http://{config.HOST}:{config.PORT}/docs")
     print(f"📖 ReDoc: http://{config.HOST}:{config.PORT}/redoc")
     print("=" * 60 + "\n")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background maintenance tasks"""
+    if _store_expiry_task:
+        _store_expiry_task.cancel()
+    await analysis_store.close()
+
+
 # ==================== Helper Functions ====================
 
-def df_to_base64_excel(df: pd.DataFrame) -> str:
-    """Convert DataFrame to base64 encoded Excel file"""
+_last_timestamp: Tuple[int, str] = (0, "")
+
+
+def now_iso() -> str:
+    """Current UTC time in ISO 8601, re-formatted at most once per second"""
+    global _last_timestamp
+    now = int(time.time())
+    if now != _last_timestamp[0]:
+        # A single tuple assignment, so concurrent readers never see a torn value
+        _last_timestamp = (now, datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+    return _last_timestamp[1]
+
+
+ALLOWED_EXTENSIONS = ('.xls', '.xlsx', '.xlsm')
+_ALLOWED_EXTENSION_SET = frozenset(ALLOWED_EXTENSIONS)
+
+
+def validate_filename(filename: Optional[str]) -> bool:
+    """Check that an uploaded file has a supported Excel extension"""
+    return bool(filename) and os.path.splitext(filename)[1].lower() in _ALLOWED_EXTENSION_SET
+
+
+# Rust-based reader for uploaded workbooks; much faster than openpyxl's XML parsing.
+# It reads cell values only (no DOM, no formulas or external links) and handles
+# .xls as well as .xlsx/.xlsm, so no per-extension engine switch is needed.
+EXCEL_READ_ENGINE = "calamine"
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXCEL_SHEET_NAME = "Merged Data"
+
+# Workbook options shared by every export (cell values are written verbatim)
+EXCEL_WRITER_OPTIONS = MappingProxyType({
+    'strings_to_formulas': False,
+    'strings_to_urls': False,
+})
+
+
+def df_to_excel_bytes(df: pd.DataFrame) -> bytes:
+    """Convert DataFrame to an in-memory Excel file.
+    
+    Rows are streamed straight into xlsxwriter in constant-memory mode, so
+    each row is flushed as soon as it is written instead of being kept in a
+    cell table. (pandas' to_excel writes column by column, which that mode
+    cannot handle.)
+    """
     buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Merged Data')
-    buffer.seek(0)
-    return base64.b64encode(buffer.read()).decode('utf-8')
+    workbook = xlsxwriter.Workbook(buffer, {
+        **EXCEL_WRITER_OPTIONS,
+        'constant_memory': True,
+        'nan_inf_to_errors': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+    })
+    try:
+        worksheet = workbook.add_worksheet(EXCEL_SHEET_NAME)
+        header_format = workbook.add_format({'bold': True})
+        worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+        
+        # Missing values become blank cells; NaN and NaT are the only values
+        # not equal to themselves, so each row is checked as it is written
+        for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row_idx, 0, [
+                None if value is pd.NA or value != value else value
+                for value in row
+            ])
+    finally:
+        workbook.close()
+    return buffer.getvalue()
+
+
+def _content_digest(content: bytes) -> str:
+    """BLAKE2b digest identifying an upload's content"""
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
 
 
-async def save_uploaded_file(upload_file: UploadFile, suffix: str = ".xlsx") -> Path:
-    """Save uploaded file to temporary location"""
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-    temp_path = Path(temp_file.name)
+async def read_uploaded_file(upload_file: UploadFile) -> Tuple[io.BytesIO, str]:
+    """Read an upload into memory.
     
+    Returns the content as a file object for the merge, and its BLAKE2b digest.
+    """
     try:
         content = await upload_file.read()
-        with open(temp_path, 'wb') as f:
-            f.write(content)
-        return temp_path
-    except Exception as e:
-        if temp_path.exists():
-            temp_path.unlink()
-        raise e
+    finally:
+        await upload_file.close()
+    digest = await run_in_threadpool(_content_digest, content)
+    return io.BytesIO(content), digest
+
+
+BUNDLE_MEMBER_STEMS = ('heating', 'ventilation')
+MAX_BUNDLE_MEMBER_SIZE = 64 << 20  # 64 MiB uncompressed per workbook
+
+
+def _extract_bundle(content: bytes) -> Tuple[Tuple[io.BytesIO, str], Tuple[io.BytesIO, str]]:
+    """Extract the heating and ventilation workbooks from a ZIP bundle.
+    
+    The archive must contain one 'heating.<ext>' and one 'ventilation.<ext>'
+    workbook (any folder); each is returned with its BLAKE2b digest.
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(content))
+    except zipfile.BadZipFile:
+        raise ValueError("Bundle is not a valid ZIP archive")
+    
+    with archive:
+        members = {}
+        for info in archive.infolist():
+            name = Path(info.filename)
+            stem = name.stem.lower()
+            if info.is_dir() or stem not in BUNDLE_MEMBER_STEMS:
+                continue
+            if stem in members:
+                raise ValueError(f"Bundle contains more than one {stem} workbook")
+            if not validate_filename(name.name):
+                raise ValueError(
+                    f"Invalid {stem} file type in bundle. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
+                )
+            if info.file_size > MAX_BUNDLE_MEMBER_SIZE:
+                raise ValueError(f"The {stem} workbook in the bundle is too large")
+            members[stem] = info
+        
+        missing = [stem for stem in BUNDLE_MEMBER_STEMS if stem not in members]
+        if missing:
+            raise ValueError(f"Bundle is missing a workbook for: {', '.join(missing)}")
+        
+        workbooks = []
+        for stem in BUNDLE_MEMBER_STEMS:
+            data = archive.read(members[stem])
+            workbooks.append((io.BytesIO(data), _content_digest(data)))
+    return workbooks[0], workbooks[1]
+
+
+async def read_uploaded_bundle(upload_file: UploadFile) -> Tuple[Tuple[io.BytesIO, str], Tuple[io.BytesIO, str]]:
+    """Read a ZIP bundle upload, returning both workbooks with their digests"""
+    try:
+        content = await upload_file.read()
+    finally:
+        await upload_file.close()
+    return await run_in_threadpool(_extract_bundle, content)
+
+
+# Candidate column names per metric, in order of preference
+PREFERRED_AREA_COLS = ('Fläche', 'Fläche_heating', 'Flaeche')
+PREFERRED_ROOMTYPE_COLS = ('Nummer Raumtyp', 'Raumtyp', 'Bezeichnung Raumtyp')
+
+
+@lru_cache(maxsize=64)
+def _pick_column(columns: tuple, candidates: tuple) -> Optional[str]:
+    """Pick the first available candidate column (cached per column layout).
+    
+    Bounded rather than functools.cache, since every uploaded layout is a new key.
+    """
+    return next((col for col in candidates if col in columns), None)
+
+
+# Columns step 2 matches rooms and room types on; their values must survive
+# storage exactly (e.g. integer room types next to a '-' placeholder)
+STEP2_KEY_COLS = ('Nummer Raumtyp', 'Raum-Nr.')
+KEY_VALUES_METADATA = b'step2_key_values'
+
+
+def _arrow_safe(df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, list]]:
+    """Make a DataFrame storable as Parquet.
+    
+    Excel columns often mix text and numbers (e.g. '-' among temperatures),
+    which Arrow cannot type; the values of such columns are stored as strings.
+    Mixed key columns are also returned as exact value lists, to be restored
+    on load.
+    """
+    mixed_cols = [
+        col for col in df.columns
+        if df[col].dtype == object
+        and pd.api.types.infer_dtype(df[col], skipna=True) in ('mixed', 'mixed-integer')
+    ]
+    if not mixed_cols and all(isinstance(col, str) for col in df.columns):
+        return df, {}
+    
+    key_values = {
+        str(col): df[col].tolist() for col in mixed_cols if col in STEP2_KEY_COLS
+    }
+    safe_df = df.copy()
+    for col in mixed_cols:
+        safe_df[col] = safe_df[col].where(safe_df[col].isna(), safe_df[col].astype(str))
+    safe_df.columns = [str(col) for col in safe_df.columns]
+    return safe_df, key_values
+
+
+def slim_for_step2(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop what step 2 never reads: merge bookkeeping and columns without any values.
+    
+    The key columns and the area column are kept even when empty, since step 2
+    looks them up by name.
+    """
+    helper_cols = [col for col in df.columns if str(col).startswith('_merge')]
+    keep_cols = {*STEP2_KEY_COLS, _pick_column(tuple(df.columns), PREFERRED_AREA_COLS)}
+    empty_cols = [
+        col for col in df.columns
+        if col not in keep_cols and col not in helper_cols and df[col].isna().all()
+    ]
+    return df.drop(columns=helper_cols + empty_cols)
+
+
+def df_to_parquet_bytes(df: pd.DataFrame) -> bytes:
+    """Serialize DataFrame to zstd-compressed Parquet"""
+    safe_df, key_values = _arrow_safe(df)
+    table = pa.Table.from_pandas(safe_df)
+    if key_values:
+        table = table.replace_schema_metadata({
+            **table.schema.metadata,
+            KEY_VALUES_METADATA: orjson.dumps(key_values, default=str),
+        })
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+    return buffer.getvalue()
+
+
+def parquet_bytes_to_df(data: bytes) -> pd.DataFrame:
+    """Load a DataFrame written by df_to_parquet_bytes"""
+    table = pq.read_table(io.BytesIO(data))
+    df = table.to_pandas()
+    raw_key_values = (table.schema.metadata or {}).get(KEY_VALUES_METADATA)
+    if raw_key_values:
+        for col, values in orjson.loads(raw_key_values).items():
+            df[col] = pd.Series(
+                [np.nan if value is None else value for value in values],
+                index=df.index,
+                dtype=object,
+            )
+    return df
 
 
 def calculate_room_metrics(df: pd.DataFrame) -> Dict:
     """Calculate room-related metrics from merged DataFrame"""
-    # Common column names for room identification
-    room_cols = ['Geschoss', 'Raum-Nr.', 'Raum-Bezeichnung', 'Nummer Raumtyp']
+    columns = tuple(df.columns)
+    area_col = _pick_column(columns, PREFERRED_AREA_COLS)
+    roomtype_col = _pick_column(columns, PREFERRED_ROOMTYPE_COLS)
     
     # Filter valid rooms (at least room number exists)
     if 'Raum-Nr.' in df.columns:
-        valid_rooms = df[df['Raum-Nr.'].notna()]
-        total_rooms = len(valid_rooms)
+        mask = df['Raum-Nr.'].notna().to_numpy()
+        total_rooms = int(mask.sum())
     else:
+        mask = slice(None)
         total_rooms = len(df)
-        valid_rooms = df
-    
-    # Calculate area metrics
-    area_col = None
-    for col in ['Fläche', 'Fläche_heating', 'Flaeche']:
-        if col in df.columns:
-            area_col = col
-            break
     
+    # Calculate area metrics on the raw float array (NaN areas are skipped)
     if area_col:
-        total_area = float(valid_rooms[area_col].sum())
-        avg_area = float(valid_rooms[area_col].mean())
+        areas = df[area_col]
+        if not pd.api.types.is_numeric_dtype(areas):
+            areas = pd.to_numeric(areas, errors='coerce')
+        areas = areas.to_numpy(dtype=np.float64, na_value=np.nan)[mask]
+        present = ~np.isnan(areas)
+        area_count = int(np.count_nonzero(present))
+        total_area = float(areas[present].sum())
+        avg_area = total_area / area_count if area_count else float('nan')
     else:
         total_area = 0.0
         avg_area = 0.0
     
     # Count unique room types
-    roomtype_col = None
-    for col in ['Nummer Raumtyp', 'Raumtyp', 'Bezeichnung Raumtyp']:
-        if col in df.columns:
-            roomtype_col = col
-            break
-    
     if roomtype_col:
-        unique_roomtypes = int(valid_rooms[roomtype_col].nunique())
+        unique_roomtypes = int(df[roomtype_col][mask].nunique())
     else:
         unique_roomtypes = 0
     
@@ -283,21 +796,438 @@ def calculate_room_metrics(df: pd.DataFrame) -> Dict:
     }
 
 
+# ==================== Concurrency Limits ====================
+
+class AnalysisLimiter:
+    """Bounds how many analyses run at once and how many may wait for a slot.
+    
+    Each analysis loads whole workbooks into memory, so bursts are queued
+    instead of run side by side, and rejected with 503 once the queue is full.
+    """
+    
+    RETRY_AFTER_SECONDS = 10
+    
+    def __init__(self, max_concurrent: int, max_queued: int):
+        self.running = asyncio.Semaphore(max_concurrent)
+        self._limit = max_concurrent + max_queued
+        self._admitted = 0
+    
+    def admit(self):
+        """Reserve a place for an analysis, or raise 503 when the queue is full"""
+        if self._admitted >= self._limit:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many analyses in progress, please retry later",
+                headers={"Retry-After": str(self.RETRY_AFTER_SECONDS)},
+            )
+        self._admitted += 1
+    
+    def release(self):
+        """Give back a place reserved with admit()"""
+        self._admitted -= 1
+
+
+analysis_limiter = AnalysisLimiter(config.MAX_CONCURRENT_ANALYSES, config.MAX_QUEUED_ANALYSES)
+
+
+# ==================== Step 1 Pipeline ====================
+
+# Merged DataFrames keyed by (heating digest, ventilation digest, header_row, auto_detect_structure).
+# Cached frames are shared between analyses and must be treated as read-only; they
+# hold every column, so only a few are kept, and no longer than the analyses themselves.
+merge_cache: TTLCache = TTLCache(maxsize=max(MERGE_CACHE_MAX, 1), ttl=STORE_TTL)
+merge_cache_lock = threading.Lock()
+
+
+async def run_step1(
+    analysis_id: str,
+    heating_file: io.BytesIO,
+    ventilation_file: io.BytesIO,
+    merge_key: Tuple,
+    project_name: Optional[str],
+    auto_detect_structure: bool,
+    header_row: Optional[int],
+    inline: Optional[str] = None,
+) -> ORJSONResponse:
+    """Merge the uploaded workbooks, compute step 1 metrics and store the analysis.
+    
+    Returns the step 1 response, with the Excel file size in X-Excel-Size.
+    """
+    # Re-uploads of identical workbooks reuse the earlier merge result
+    with merge_cache_lock:
+        merged_df = merge_cache.get(merge_key)
+    
+    await analysis_store.set_progress(analysis_id, "step1", 10)
+    
+    if merged_df is not None:
+        print(f"♻️ Reusing cached merge result for analysis {analysis_id}")
+    else:
+        # Merge Excel files using existing utility
+        merged_df = await merge_heating_ventilation_excel(
+            heating_file,
+            ventilation_file,
+            header_row=header_row,
+            auto_detect_structure=auto_detect_structure,
+            how='outer',
+            engine=EXCEL_READ_ENGINE,
+        )
+        if MERGE_CACHE_MAX:
+            with merge_cache_lock:
+                merge_cache[merge_key] = merged_df
+    
+    if merged_df.empty:
+        raise ValueError("Merged DataFrame is empty. Please check the input files.")
+    
+    await analysis_store.set_progress(analysis_id, "step1", 50)
+    
+    # Calculate metrics
+    metrics = await run_in_threadpool(calculate_room_metrics, merged_df)
+    
+    # Serialize merged DataFrame to Excel (served by GET /api/analyze/{id}/excel)
+    excel_bytes = await run_in_threadpool(df_to_excel_bytes, merged_df)
+    suggested_filename = f"merged_analysis_{analysis_id[:8]}.xlsx"
+    await analysis_store.set_progress(analysis_id, "step1", 80)
+    
+    # Calculate room type optimization metrics
+    # Note: The actual room type matching could be done with roomtypes.service.process()
+    # if Nummer Raumtyp column needs to be filled or corrected
+    total_rooms = metrics['total_rooms']
+    optimized_rooms = int(total_rooms * 0.90)  # 90% of rooms successfully merged/matched
+    improvement_rate = 90.0
+    confidence = 98.0
+    
+    # Prepare response
+    step1_data = Step1Data(
+        optimizedRooms=optimized_rooms,
+        totalRooms=total_rooms,
+        improvementRate=improvement_rate,
+        confidence=confidence,
+    )
+    
+    details = Step1Details(
+        originalRoomTypesCount=metrics['unique_roomtypes'],
+        optimizedRoomTypesCount=max(metrics['unique_roomtypes'] - 5, 1),
+        avgRoomSizeM2=round(metrics['avg_area'], 1),
+        totalAreaM2=round(metrics['total_area'], 0),
+        keyChanges=[
+            KeyChange(**{"from": "Büro Standard", "to": "Büro Optimiert", "count": 5}),
+            KeyChange(**{"from": "Konferenzraum Groß", "to": "Konferenzraum Optimiert", "count": 3}),
+        ]
+    )
+    
+    response = dump_response(STEP1_RESPONSE_ADAPTER, Step1Response(
+        analysisId=analysis_id,
+        processedExcelUrl=f"/api/analyze/{analysis_id}/excel",
+        processedExcelFilename=suggested_filename,
+        step1=step1_data,
+        details=details,
+    ))
+    
+    # Store analysis data for step 2; only the columns it uses are kept, as
+    # compressed Parquet, which is far smaller than the frame and cheap to load back
+    slim_df = slim_for_step2(merged_df)
+    slim_df_parquet = await run_in_threadpool(df_to_parquet_bytes, slim_df)
+    await analysis_store.save(analysis_id, {
+        "state": "completed",
+        "slim_df_parquet": slim_df_parquet,
+        "area_col": _pick_column(tuple(slim_df.columns), PREFERRED_AREA_COLS),
+        "metrics": metrics,
+        "project_name": project_name or "Unnamed Project",
+        "step1_data": step1_data,
+        "details": details,
+        "step1_response": response,
+        "excel_bytes": excel_bytes,
+        "excel_filename": suggested_filename,
+        "excel_size": len(excel_bytes),
+    })
+    await analysis_store.set_progress(analysis_id, "step1", 100)
+    
+    if inline == "base64":
+        response = {
+            **response,
+            "processedExcelBase64": base64.b64encode(excel_bytes).decode('ascii'),
+        }
+    
+    return step1_json_response(response, len(excel_bytes))
+
+
+async def run_step1_in_background(cleanup: contextlib.ExitStack, analysis_id: str, **kwargs):
+    """Run step 1 after the response was sent, recording failures in the store"""
+    with cleanup:
+        try:
+            async with analysis_limiter.running:
+                await run_step1(analysis_id, **kwargs)
+            print(f"✅ Background step1 complete for analysis {analysis_id}")
+        except Exception as e:
+            import traceback
+            print(f"❌ Error in background step1: {traceback.format_exc()}")
+            await analysis_store.save(analysis_id, {"state": "failed", "error": str(e)})
+
+
+async def start_step1(
+    background_tasks: BackgroundTasks,
+    read_inputs: Callable[[], Awaitable],
+    sources: Tuple[str, str],
+    project_name: Optional[str],
+    auto_detect_structure: bool,
+    header_row: Optional[int],
+    background: bool,
+    inline: Optional[str],
+):
+    """Shared body of the step 1 endpoints.
+    
+    read_inputs returns ((heating_file, digest), (ventilation_file, digest));
+    it is only called once the analysis has a place in the queue.
+    """
+    if background and inline == "base64":
+        # A background run answers before the Excel file exists; it is
+        # downloaded from processedExcelUrl once the analysis completes
+        raise HTTPException(
+            status_code=400,
+            detail="inline=base64 cannot be combined with background processing; "
+                   "download the Excel file from processedExcelUrl instead",
+        )
+    
+    # Generate analysis ID
+    analysis_id = uuid.uuid4().hex
+    
+    # The analysis' place in the queue is released exactly once on exit
+    with contextlib.ExitStack() as cleanup:
+        analysis_limiter.admit()
+        cleanup.callback(analysis_limiter.release)
+        
+        try:
+            (heating_file, heating_digest), (ventilation_file, ventilation_digest) = await read_inputs()
+            
+            print(f"\n📤 Processing uploaded files:")
+            print(f"   Heating: {sources[0]}")
+            print(f"   Ventilation: {sources[1]}")
+            print(f"   Analysis ID: {analysis_id}")
+            
+            step1_kwargs = dict(
+                heating_file=heating_file,
+                ventilation_file=ventilation_file,
+                merge_key=(heating_digest, ventilation_digest, header_row, auto_detect_structure),
+                project_name=project_name,
+                auto_detect_structure=auto_detect_structure,
+                header_row=header_row,
+            )
+            
+            if background:
+                # The background task takes over releasing the queue place
+                await analysis_store.save(analysis_id, {"state": "processing"})
+                background_tasks.add_task(
+                    run_step1_in_background, cleanup.pop_all(), analysis_id, **step1_kwargs
+                )
+                return ORJSONResponse(
+                    status_code=202,
+                    content={"analysisId": analysis_id, "state": "processing"},
+                )
+            
+            async with analysis_limiter.running:
+                return await run_step1(analysis_id, inline=inline, **step1_kwargs)
+            
+        except ValueError as e:
+            # Specific validation errors
+            raise HTTPException(
+                status_code=400,
+                detail=f"Validation error: {str(e)}"
+            )
+            
+        except Exception as e:
+            import traceback
+            error_trace = traceback.format_exc()
+            print(f"❌ Error in step1: {error_trace}")
+            
+            raise HTTPException(
+                status_code=422,
+                detail=f"Failed to process Excel files: {str(e)}"
+            )
+
+
+# ==================== Step 2 Pipeline ====================
+
+async def run_step2(analysis_id: str, analysis_data: Dict, parameters: Optional[Dict] = None) -> Dict:
+    """Estimate power for the merged rooms of a completed step 1 and store the results.
+    
+    Returns the step 2 response as JSON-ready data.
+    """
+    merged_df = await run_in_threadpool(parquet_bytes_to_df, analysis_data["slim_df_parquet"])
+    await analysis_store.set_progress(analysis_id, "step2", 10)
+    
+    # Get parameters from request
+    price_per_kwh = parameters.get("pricePerKWh", 0.30) if parameters else 0.30
+    
+    print(f"\n🔋 Starting power estimation for analysis {analysis_id}")
+    
+    # Run power estimation analysis
+    power_estimates = await test_cost_analysis(
+        merged_df,
+        skip_structure_analysis=True,
+        types=ROOM_TYPES,
+        context_path=POWER_CONTEXT_PATH,
+    )
+    
+    await analysis_store.set_progress(analysis_id, "step2", 80)
+    
+    if not power_estimates:
+        # Fallback to simulated data if estimation fails
+        print("⚠️ Power estimation returned no results, using simulated data")
+        step2_data = Step2Data(
+            energyConsumption=45.0,
+            reductionPercentage=18.0,
+            annualSavings=7800.0,
+        )
+        
+        details = Step2Details(
+            heatingPowerKw=57.0,
+            annualConsumptionKwh=143820.0,
+            savingsKwh=25680.0,
+            breakdownByRoomType=[
+                RoomTypeBreakdown(roomType="Büros", wPerM2=42.0, sharePercent=40.0),
+                RoomTypeBreakdown(roomType="Konferenzräume", wPerM2=55.0, sharePercent=25.0),
+            ]
+        )
+    else:
+        # Calculate aggregated metrics from power estimates
+        est_df = pd.DataFrame.from_dict(power_estimates, orient='index')
+        
+        # Area of each room, taken from its first row in the merged data
+        # (no rooms can be matched if the upload has no room numbers)
+        if 'Raum-Nr.' in merged_df.columns:
+            first_rows = merged_df.drop_duplicates('Raum-Nr.')
+        else:
+            first_rows = merged_df.iloc[:0].assign(**{'Raum-Nr.': []})
+        area_col = analysis_data.get("area_col")
+        if area_col in first_rows.columns:
+            areas = pd.to_numeric(first_rows[area_col], errors='coerce').to_numpy()
+        else:
+            areas = 20.0  # Default area
+        area_by_room = pd.Series(areas, index=first_rows['Raum-Nr.'].to_numpy(), dtype='float64')
+        
+        # Skip estimates for rooms that aren't in the merged data
+        est_df = est_df[est_df.index.isin(area_by_room.index)].copy()
+        est_df['area'] = est_df.index.map(area_by_room)
+        
+        # Calculate power
+        est_df['heating_w'] = est_df['heating_W_per_m2'] * est_df['area']
+        est_df['cooling_w'] = est_df['cooling_W_per_m2'] * est_df['area']
+        est_df['room_type_name'] = est_df['room_type'].map(lambda rt: ROOM_TYPES.get(rt, f"Type {rt}"))
+        
+        total_heating_w = float(est_df['heating_w'].sum())
+        total_cooling_w = float(est_df['cooling_w'].sum())
+        total_area = float(est_df['area'].sum())
+        
+        # Group by room type (in order of first appearance)
+        room_type_stats = est_df.groupby('room_type_name', sort=False).agg(
+            total_heating_w=('heating_w', 'sum'),
+            total_area=('area', 'sum'),
+        )
+        
+        # Calculate metrics
+        avg_heating_w_per_m2 = total_heating_w / total_area if total_area > 0 else 0
+        total_heating_kw = total_heating_w / 1000
+        
+        # Estimate annual consumption (assuming heating season ~2000h, cooling ~800h)
+        annual_heating_kwh = total_heating_kw * 2000
+        annual_cooling_kwh = (total_cooling_w / 1000) * 800
+        annual_total_kwh = annual_heating_kwh + annual_cooling_kwh
+        
+        # Assumed baseline and reduction
+        baseline_kwh = annual_total_kwh * 1.22  # 22% higher before optimization
+        savings_kwh = baseline_kwh - annual_total_kwh
+        reduction_percentage = (savings_kwh / baseline_kwh * 100) if baseline_kwh > 0 else 0
+        annual_savings_eur = savings_kwh * price_per_kwh
+        
+        # Create breakdown by room type
+        breakdown = []
+        for room_type_name, type_heating_w, type_area in room_type_stats.itertuples():
+            avg_w_per_m2 = type_heating_w / type_area if type_area > 0 else 0
+            share_percent = type_area / total_area * 100 if total_area > 0 else 0
+            
+            breakdown.append(RoomTypeBreakdown(
+                roomType=room_type_name,
+                wPerM2=round(avg_w_per_m2, 1),
+                sharePercent=round(share_percent, 1)
+            ))
+        
+        step2_data = Step2Data(
+            energyConsumption=round(avg_heating_w_per_m2, 1),
+            reductionPercentage=round(reduction_percentage, 1),
+            annualSavings=round(annual_savings_eur, 0),
+        )
+        
+        details = Step2Details(
+            heatingPowerKw=round(total_heating_kw, 1),
+            annualConsumptionKwh=round(annual_total_kwh, 0),
+            savingsKwh=round(savings_kwh, 0),
+            breakdownByRoomType=breakdown
+        )
+    
+    # Update stored data with step2 results
+    analysis_data["step2_data"] = step2_data
+    analysis_data["step2_details"] = details
+    analysis_data["power_estimates"] = power_estimates
+    analysis_data["step2_state"] = "completed"
+    analysis_data.pop("step2_error", None)
+    
+    print(f"✅ Power estimation complete for analysis {analysis_id}")
+    
+    response = dump_response(STEP2_RESPONSE_ADAPTER, Step2Response(
+        step2=step2_data,
+        details=details,
+    ))
+    analysis_data["step2_response"] = response
+    await analysis_store.save(analysis_id, analysis_data)
+    await analysis_store.set_progress(analysis_id, "step2", 100)
+    
+    return response
+
+
+async def run_step2_in_background(analysis_id: str, analysis_data: Dict, parameters: Optional[Dict] = None):
+    """Run step 2 after the response was sent, recording failures in the store"""
+    try:
+        async with analysis_limiter.running:
+            await run_step2(analysis_id, analysis_data, parameters)
+        print(f"✅ Background step2 complete for analysis {analysis_id}")
+    except Exception as e:
+        import traceback
+        print(f"❌ Error in background step2: {traceback.format_exc()}")
+        await analysis_store.save(analysis_id, {**analysis_data, "step2_state": "failed", "step2_error": str(e)})
+    finally:
+        analysis_limiter.release()
+
+
 # ==================== Endpoints ====================
 
 @app.get("/healthz")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "ok", "timestamp": datetime.now().isoformat()}
+    return {"status": "ok", "timestamp": now_iso()}
+
+
+@app.head("/healthz", include_in_schema=False)
+async def health_check_head():
+    """Liveness check without a body"""
+    return Response()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Basic runtime metrics"""
+    return {"analysesStored": await analysis_store.count()}
 
 
 @app.post("/api/analyze/step1", response_model=Step1Response)
 async def analyze_step1(
+    background_tasks: BackgroundTasks,
     file_heating: UploadFile = File(..., description="Heating/Cooling Excel file (KLT/HZG)"),
     file_ventilation: UploadFile = File(..., description="Ventilation Excel file (RLT)"),
     project_name: Optional[str] = Form(None),
     auto_detect_structure: bool = Form(True),
     header_row: Optional[int] = Form(None),
+    background: bool = Form(False, description="Return immediately and process in the background"),
+    inline: Optional[str] = Query(None, description="Set to 'base64' to embed the Excel file in the response"),
 ):
     """
     Step 1: Upload and merge Excel files, optimize room types
@@ -308,352 +1238,160 @@ async def analyze_step1(
     - project_name: Optional project name
     - auto_detect_structure: Use AI to detect Excel structure (default: True)
     - header_row: Manual header row number if auto_detect_structure=False
+    - background: Return 202 with only the analysisId and process in the background;
+      poll /api/status/{id} and fetch the result from /api/analyze/{id}/step1 (default: False)
+    - inline (query): 'base64' to also embed the merged Excel file in the response (not with background)
     
     Returns:
     - analysisId: Unique ID for subsequent API calls
-    - processedExcelBase64: Base64 encoded merged Excel file
+    - processedExcelUrl: Download URL of the merged Excel file
+    - processedExcelBase64: Base64 encoded merged Excel file (only with ?inline=base64)
     - step1: Core metrics (rooms, improvement rate, confidence)
     - details: Additional metrics and changes
     """
     
     # Validate file types
-    allowed_extensions = ['.xls', '.xlsx', '.xlsm']
-    
-    def validate_filename(filename: str) -> bool:
-        return any(filename.lower().endswith(ext) for ext in allowed_extensions)
-    
     if not validate_filename(file_heating.filename):
         raise HTTPException(
             status_code=400,
-            detail=f"Invalid heating file type. Allowed: {', '.join(allowed_extensions)}"
+            detail=f"Invalid heating file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
         )
     
     if not validate_filename(file_ventilation.filename):
         raise HTTPException(
             status_code=400,
-            detail=f"Invalid ventilation file type. Allowed: {', '.join(allowed_extensions)}"
+            detail=f"Invalid ventilation file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
         )
     
-    # Generate analysis ID
-    analysis_id = str(uuid.uuid4())
+    async def read_inputs():
+        # Read both uploads concurrently; the merge parses them from memory
+        return await asyncio.gather(
+            read_uploaded_file(file_heating),
+            read_uploaded_file(file_ventilation),
+        )
     
-    # Save uploaded files temporarily
-    heating_path = None
-    ventilation_path = None
+    return await start_step1(
+        background_tasks,
+        read_inputs,
+        sources=(file_heating.filename, file_ventilation.filename),
+        project_name=project_name,
+        auto_detect_structure=auto_detect_structure,
+        header_row=header_row,
+        background=background,
+        inline=inline,
+    )
+
+
+@app.post("/api/analyze/step1/bundle", response_model=Step1Response)
+async def analyze_step1_bundle(
+    background_tasks: BackgroundTasks,
+    bundle: UploadFile = File(..., description="ZIP archive with heating.<ext> and ventilation.<ext>"),
+    project_name: Optional[str] = Form(None),
+    auto_detect_structure: bool = Form(True),
+    header_row: Optional[int] = Form(None),
+    background: bool = Form(False, description="Return immediately and process in the background"),
+    inline: Optional[str] = Query(None, description="Set to 'base64' to embed the Excel file in the response"),
+):
+    """
+    Step 1 with both workbooks uploaded as a single ZIP archive
     
-    try:
-        # Determine file extension
-        heating_suffix = Path(file_heating.filename).suffix
-        ventilation_suffix = Path(file_ventilation.filename).suffix
-        
-        heating_path = await save_uploaded_file(file_heating, suffix=heating_suffix)
-        ventilation_path = await save_uploaded_file(file_ventilation, suffix=ventilation_suffix)
-        
-        print(f"\n📤 Processing uploaded files:")
-        print(f"   Heating: {file_heating.filename}")
-        print(f"   Ventilation: {file_ventilation.filename}")
-        print(f"   Analysis ID: {analysis_id}")
-        
-        # Merge Excel files using existing utility
-        merged_df = await merge_heating_ventilation_excel(
-            str(heating_path),
-            str(ventilation_path),
-            header_row=header_row,
-            auto_detect_structure=auto_detect_structure,
-            how='outer',
-        )
-        
-        if merged_df.empty:
-            raise ValueError("Merged DataFrame is empty. Please check the input files.")
-        
-        # Calculate metrics
-        metrics = calculate_room_metrics(merged_df)
-        
-        # Convert merged DataFrame to base64
-        excel_base64 = df_to_base64_excel(merged_df)
-        suggested_filename = f"merged_analysis_{analysis_id[:8]}.xlsx"
-        
-        # Calculate room type optimization metrics
-        # Note: The actual room type matching could be done with roomtypes.service.process()
-        # if Nummer Raumtyp column needs to be filled or corrected
-        total_rooms = metrics['total_rooms']
-        optimized_rooms = int(total_rooms * 0.90)  # 90% of rooms successfully merged/matched
-        improvement_rate = 90.0
-        confidence = 98.0
-        
-        # Prepare response
-        step1_data = Step1Data(
-            optimizedRooms=optimized_rooms,
-            totalRooms=total_rooms,
-            improvementRate=improvement_rate,
-            confidence=confidence,
-        )
-        
-        details = Step1Details(
-            originalRoomTypesCount=metrics['unique_roomtypes'],
-            optimizedRoomTypesCount=max(metrics['unique_roomtypes'] - 5, 1),
-            avgRoomSizeM2=round(metrics['avg_area'], 1),
-            totalAreaM2=round(metrics['total_area'], 0),
-            keyChanges=[
-                KeyChange(**{"from": "Büro Standard", "to": "Büro Optimiert", "count": 5}),
-                KeyChange(**{"from": "Konferenzraum Groß", "to": "Konferenzraum Optimiert", "count": 3}),
-            ]
-        )
-        
-        # Store analysis data for step 2
-        analysis_store.save(analysis_id, {
-            "merged_df": merged_df.to_dict(),
-            "metrics": metrics,
-            "project_name": project_name or "Unnamed Project",
-            "step1_data": step1_data.model_dump(),
-            "details": details.model_dump(),
-        })
-        
-        response = Step1Response(
-            analysisId=analysis_id,
-            processedExcelBase64=excel_base64,
-            processedExcelFilename=suggested_filename,
-            step1=step1_data,
-            details=details,
-        )
-        
-        return response
-        
-    except ValueError as e:
-        # Specific validation errors
-        if heating_path and heating_path.exists():
-            heating_path.unlink()
-        if ventilation_path and ventilation_path.exists():
-            ventilation_path.unlink()
-        
-        raise HTTPException(
-            status_code=400,
-            detail=f"Validation error: {str(e)}"
-        )
-        
-    except Exception as e:
-        # Clean up temporary files
-        if heating_path and heating_path.exists():
-            heating_path.unlink()
-        if ventilation_path and ventilation_path.exists():
-            ventilation_path.unlink()
-        
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"❌ Error in step1: {error_trace}")
-        
-        raise HTTPException(
-            status_code=422,
-            detail=f"Failed to process Excel files: {str(e)}"
-        )
+    The archive must contain one heating and one ventilation workbook named
+    heating.<ext> and ventilation.<ext> (.xls, .xlsx, .xlsm). Workbooks are
+    already compressed, so the archive can use ZIP_STORED. All other fields
+    and the response are the same as for /api/analyze/step1.
+    """
+    if not bundle.filename or Path(bundle.filename).suffix.lower() != ".zip":
+        raise HTTPException(status_code=400, detail="Invalid bundle file type. Allowed: .zip")
     
-    finally:
-        # Clean up temporary files
-        if heating_path and heating_path.exists():
-            try:
-                heating_path.unlink()
-            except:
-                pass
-        if ventilation_path and ventilation_path.exists():
-            try:
-                ventilation_path.unlink()
-            except:
-                pass
+    return await start_step1(
+        background_tasks,
+        lambda: read_uploaded_bundle(bundle),
+        sources=(f"{bundle.filename}:heating", f"{bundle.filename}:ventilation"),
+        project_name=project_name,
+        auto_detect_structure=auto_detect_structure,
+        header_row=header_row,
+        background=background,
+        inline=inline,
+    )
+
+
+@app.get("/api/analyze/{analysis_id}/step1", response_model=Step1Response)
+async def get_step1_result(analysis_id: str):
+    """
+    Get the step 1 result of an analysis started with background=true
+    """
+    analysis_data = await analysis_store.get(analysis_id)
+    if not analysis_data:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    
+    if analysis_data.get("state") == "failed":
+        raise HTTPException(status_code=409, detail=f"Step 1 failed: {analysis_data.get('error')}")
+    
+    if "step1_response" not in analysis_data:
+        raise HTTPException(status_code=409, detail="Step 1 is still processing")
+    
+    return step1_json_response(analysis_data["step1_response"], analysis_data.get("excel_size"))
 
 
 @app.post("/api/analyze/step2", response_model=Step2Response)
-async def analyze_step2(request: Step2Request):
+async def analyze_step2(request: Step2Request, background_tasks: BackgroundTasks):
     """
     Step 2: Energy consumption and cost analysis
     
     Accepts:
     - analysisId: ID from step 1
     - parameters: Optional parameters (pricePerKWh, climateZone, etc.)
+    - background: Return 202 and process in the background; poll /api/status/{id}
+      and fetch the result from /api/analyze/{id}/step2 (default: False)
     
     Returns:
     - step2: Energy metrics (consumption, savings, reduction %)
     - details: Detailed breakdown by room type
     """
     
-    # Check if analysis exists
-    if not analysis_store.exists(request.analysisId):
+    # Check that the analysis exists and step 1 completed (metadata only)
+    analysis_meta, _ = await analysis_store.get_meta(request.analysisId)
+    if analysis_meta is None:
         raise HTTPException(
             status_code=404,
             detail=f"Analysis ID not found: {request.analysisId}"
         )
     
-    # Get stored data
-    analysis_data = analysis_store.get(request.analysisId)
+    if "step1_data" not in analysis_meta:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Step 1 is not completed for analysis: {request.analysisId}"
+        )
     
-    try:
-        # Reconstruct DataFrame from stored data
-        merged_df = pd.DataFrame.from_dict(analysis_data["merged_df"])
-        
-        # Room type mapping (should ideally come from config or database)
-        types = {
-            1: "Flex-/ Co-Work/",
-            2: "Einzel-/Zweierbüros",
-            3: "Technikum",
-            4: "Smart Farming",
-            5: "Robotik",
-            6: "Verkehrsflächen, Flure",
-            7: "Teeküchen",
-            8: "WCs",
-            9: "ELT-Zentrale",
-            10: "Putzmittel/ Lager",
-            11: "Lager innenliegend",
-            12: "TGA-Zentrale",
-            13: "Etagenverteiler",
-            14: "ELT-Schacht",
-            15: "Batterieräume",
-            16: "Drucker-/Kopierräume",
-            17: "Treppenhäuser/Magistrale",
-            18: "Schächte",
-            19: "Aufzüge",
-            20: "Seminarraum",
-            21: "Diele"
-        }
-        
-        # Get parameters from request
-        price_per_kwh = request.parameters.get("pricePerKWh", 0.30) if request.parameters else 0.30
-        
-        print(f"\n🔋 Starting power estimation for analysis {request.analysisId}")
-        
-        # Change to power directory for context.json access
-        original_cwd = os.getcwd()
-        power_dir = Path(__file__).parent / "power"
-        os.chdir(power_dir)
-        
+    # Get stored data, including the merged frame
+    analysis_data = await analysis_store.get(request.analysisId)
+    if not analysis_data or "slim_df_parquet" not in analysis_data:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Analysis ID not found: {request.analysisId}"
+        )
+    
+    analysis_limiter.admit()
+    
+    if request.background:
+        # The background task takes over releasing the queue place
         try:
-            # Run power estimation analysis
-            power_estimates = await test_cost_analysis(
-                merged_df,
-                skip_structure_analysis=True,
-                types=types
-            )
-        finally:
-            # Restore original working directory
-            os.chdir(original_cwd)
-        
-        if not power_estimates:
-            # Fallback to simulated data if estimation fails
-            print("⚠️ Power estimation returned no results, using simulated data")
-            step2_data = Step2Data(
-                energyConsumption=45.0,
-                reductionPercentage=18.0,
-                annualSavings=7800.0,
-            )
-            
-            details = Step2Details(
-                heatingPowerKw=57.0,
-                annualConsumptionKwh=143820.0,
-                savingsKwh=25680.0,
-                breakdownByRoomType=[
-                    RoomTypeBreakdown(roomType="Büros", wPerM2=42.0, sharePercent=40.0),
-                    RoomTypeBreakdown(roomType="Konferenzräume", wPerM2=55.0, sharePercent=25.0),
-                ]
-            )
-        else:
-            # Calculate aggregated metrics from power estimates
-            total_heating_w = 0
-            total_cooling_w = 0
-            total_area = 0
-            room_type_stats = {}
-            
-            for room_nr, estimates in power_estimates.items():
-                # Find room in DataFrame
-                room_data = merged_df[merged_df['Raum-Nr.'] == room_nr]
-                if room_data.empty:
-                    continue
-                
-                # Get area
-                area_col = None
-                for col in ['Fläche', 'Fläche_heating', 'Flaeche']:
-                    if col in merged_df.columns:
-                        area_col = col
-                        break
-                
-                if area_col:
-                    area = float(room_data[area_col].iloc[0])
-                else:
-                    area = 20.0  # Default area
-                
-                total_area += area
-                
-                # Calculate power
-                heating_w = estimates['heating_W_per_m2'] * area
-                cooling_w = estimates['cooling_W_per_m2'] * area
-                
-                total_heating_w += heating_w
-                total_cooling_w += cooling_w
-                
-                # Group by room type
-                room_type = estimates.get('room_type', 0)
-                room_type_name = types.get(room_type, f"Type {room_type}")
-                
-                if room_type_name not in room_type_stats:
-                    room_type_stats[room_type_name] = {
-                        'total_heating_w': 0,
-                        'total_area': 0,
-                        'count': 0
-                    }
-                
-                room_type_stats[room_type_name]['total_heating_w'] += heating_w
-                room_type_stats[room_type_name]['total_area'] += area
-                room_type_stats[room_type_name]['count'] += 1
-            
-            # Calculate metrics
-            avg_heating_w_per_m2 = total_heating_w / total_area if total_area > 0 else 0
-            total_heating_kw = total_heating_w / 1000
-            
-            # Estimate annual consumption (assuming heating season ~2000h, cooling ~800h)
-            annual_heating_kwh = total_heating_kw * 2000
-            annual_cooling_kwh = (total_cooling_w / 1000) * 800
-            annual_total_kwh = annual_heating_kwh + annual_cooling_kwh
-            
-            # Assumed baseline and reduction
-            baseline_kwh = annual_total_kwh * 1.22  # 22% higher before optimization
-            savings_kwh = baseline_kwh - annual_total_kwh
-            reduction_percentage = (savings_kwh / baseline_kwh * 100) if baseline_kwh > 0 else 0
-            annual_savings_eur = savings_kwh * price_per_kwh
-            
-            # Create breakdown by room type
-            breakdown = []
-            for room_type_name, stats in room_type_stats.items():
-                avg_w_per_m2 = stats['total_heating_w'] / stats['total_area'] if stats['total_area'] > 0 else 0
-                share_percent = stats['total_area'] / total_area * 100 if total_area > 0 else 0
-                
-                breakdown.append(RoomTypeBreakdown(
-                    roomType=room_type_name,
-                    wPerM2=round(avg_w_per_m2, 1),
-                    sharePercent=round(share_percent, 1)
-                ))
-            
-            step2_data = Step2Data(
-                energyConsumption=round(avg_heating_w_per_m2, 1),
-                reductionPercentage=round(reduction_percentage, 1),
-                annualSavings=round(annual_savings_eur, 0),
-            )
-            
-            details = Step2Details(
-                heatingPowerKw=round(total_heating_kw, 1),
-                annualConsumptionKwh=round(annual_total_kwh, 0),
-                savingsKwh=round(savings_kwh, 0),
-                breakdownByRoomType=breakdown
-            )
-        
-        # Update stored data with step2 results
-        analysis_data["step2_data"] = step2_data.model_dump()
-        analysis_data["step2_details"] = details.model_dump()
-        analysis_data["power_estimates"] = power_estimates
-        analysis_store.save(request.analysisId, analysis_data)
-        
-        print(f"✅ Power estimation complete for analysis {request.analysisId}")
-        
-        return Step2Response(
-            step2=step2_data,
-            details=details,
+            await analysis_store.save(request.analysisId, {**analysis_data, "step2_state": "processing"})
+            await analysis_store.set_progress(request.analysisId, "step2", 0)
+        except Exception:
+            analysis_limiter.release()
+            raise
+        background_tasks.add_task(
+            run_step2_in_background, request.analysisId, analysis_data, request.parameters
+        )
+        return ORJSONResponse(
+            status_code=202,
+            content={"analysisId": request.analysisId, "state": "processing"},
         )
+    
+    try:
+        async with analysis_limiter.running:
+            return ORJSONResponse(await run_step2(request.analysisId, analysis_data, request.parameters))
         
     except Exception as e:
         import traceback
@@ -663,6 +1401,43 @@ async def analyze_step2(request: Step2Request):
             status_code=500,
             detail=f"Failed to calculate energy metrics: {str(e)}"
         )
+    finally:
+        analysis_limiter.release()
+
+
+@app.get("/api/analyze/{analysis_id}/step2", response_model=Step2Response)
+async def get_step2_result(analysis_id: str):
+    """
+    Get the step 2 result of an analysis started with background=true
+    """
+    analysis_data = await analysis_store.get(analysis_id)
+    if not analysis_data:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    
+    if analysis_data.get("step2_state") == "failed":
+        raise HTTPException(status_code=409, detail=f"Step 2 failed: {analysis_data.get('step2_error')}")
+    
+    if "step2_response" not in analysis_data:
+        raise HTTPException(status_code=409, detail="Step 2 has not completed")
+    
+    return ORJSONResponse(analysis_data["step2_response"])
+
+
+@app.get("/api/analyze/{analysis_id}/excel")
+async def download_excel(analysis_id: str):
+    """
+    Download the merged Excel file produced by step 1
+    """
+    excel = await analysis_store.get_excel(analysis_id)
+    if excel is None:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    
+    excel_bytes, excel_filename = excel
+    return Response(
+        content=excel_bytes,
+        media_type=XLSX_MEDIA_TYPE,
+        headers={"Content-Disposition": f'attachment; filename="{excel_filename}"'},
+    )
 
 
 @app.get("/api/status/{analysis_id}")
@@ -670,16 +1445,28 @@ async def get_status(analysis_id: str):
     """
     Get analysis status (for async processing)
     """
-    if not analysis_store.exists(analysis_id):
+    # Polled by clients, so only the metadata is read, never the stored files
+    analysis_data, progress = await analysis_store.get_meta(analysis_id)
+    if analysis_data is None:
         raise HTTPException(status_code=404, detail="Analysis not found")
     
-    analysis_data = analysis_store.get(analysis_id)
-    
     # Determine completion state
     has_step1 = "step1_data" in analysis_data
     has_step2 = "step2_data" in analysis_data
+    step2_state = analysis_data.get("step2_state")
     
-    if has_step2:
+    if analysis_data.get("state") == "failed":
+        state = "failed"
+        step = "step1"
+        error = analysis_data.get("error")
+    elif step2_state == "failed":
+        state = "failed"
+        step = "step2"
+        error = analysis_data.get("step2_error")
+    elif step2_state == "processing":
+        state = "processing"
+        step = "step2"
+    elif has_step2:
         state = "completed"
         step = "report"
     elif has_step1:
@@ -687,14 +1474,25 @@ async def get_status(analysis_id: str):
         step = "step1"
     else:
         state = "processing"
-        step = None
+        step = "step1"
     
-    return {
+    if state != "processing":
+        progress_percent = 100
+    elif progress and progress["step"] == step:
+        progress_percent = progress["percent"]
+    else:
+        progress_percent = 0
+    
+    status = {
         "analysisId": analysis_id,
         "state": state,
         "step": step,
-        "progressPercent": 100 if state == "completed" else 50,
+        "progressPercent": progress_percent,
     }
+    if state == "failed":
+        status["error"] = error
+    
+    return status
 
 
 # ==================== Run Server ====================
@@ -705,9 +1503,21 @@ if __name__ == "__main__":
     # Validate config before starting
     config.validate()
     
+    # Workers don't share the in-memory store, so more than one requires Redis
+    workers = config.WEB_CONCURRENCY
+    if workers > 1 and not REDIS_URL:
+        print(f"⚠️ WEB_CONCURRENCY={workers} requires REDIS_URL, running a single worker")
+        workers = 1
+        # The startup check (also run by the reloader's subprocess) sees one worker
+        config.WEB_CONCURRENCY = 1
+        os.environ["WEB_CONCURRENCY"] = "1"
+    
+    # uvloop and httptools (from uvicorn[standard]) are picked automatically
+    # where available; Windows falls back to asyncio and h11
     uvicorn.run(
         "src.api:app",
         host=config.HOST,
         port=config.PORT,
-        reload=config.RELOAD
+        reload=config.RELOAD,
+        workers=None if config.RELOAD else workers,
     )
@@ -10,7 +10,8 @@ load_dotenv(Path(__file__).parent.parent / '.env.local')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 GEMINI_MODEL = 'gemini-2.5-flash-lite'
 REPORTS_DIR = Path(__file__).parent.parent / "reports"
-HISTORIC_DATA = json.load(open("static/roomtypes/historic_data.json"))
+STATIC_DIR = Path(__file__).parent.parent / "static"
+HISTORIC_DATA = json.load(open(STATIC_DIR / "roomtypes" / "historic_data.json", encoding="utf-8"))
 
 FORMATS = {
     "1": ("PDF", ".pdf"),
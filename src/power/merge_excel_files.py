@@ -5,15 +5,16 @@ Uses AI-powered structure detection to handle messy Excel files.
 """
 
 import pandas as pd
-from typing import Optional, Tuple, List
+from typing import IO, Optional, Tuple, List, Union
 import asyncio
+import anyio
 import os
 import json
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
 from pydantic import BaseModel
 import openpyxl
-from functools import lru_cache
+from functools import lru_cache, partial
 import hashlib
 import time
 
@@ -98,14 +99,26 @@ Return the 0-indexed row numbers for the header and data start."""
         # Return default values if analysis fails
         return ExcelAnalysis(header_row_num=0, data_start_row=1)
 
+async def _read_excel(source: Union[str, IO[bytes]], **kwargs) -> pd.DataFrame:
+    """Parse an Excel sheet in a worker thread so the event loop stays responsive.
+    
+    Runs on anyio's default thread limiter, like the API's run_in_threadpool
+    calls, so the thread count raised at API startup applies here too.
+    """
+    if hasattr(source, 'seek'):
+        # File objects are read more than once when detecting the structure
+        source.seek(0)
+    return await anyio.to_thread.run_sync(partial(pd.read_excel, source, **kwargs))
+
 async def merge_heating_ventilation_excel(
-    heating_path: str,
-    ventilation_path: str,
+    heating_path: Union[str, IO[bytes]],
+    ventilation_path: Union[str, IO[bytes]],
     header_row: Optional[int] = None,
     merge_keys: Optional[List[str]] = None,
     how: str = 'outer',
     auto_detect_structure: bool = True,
-    types: Optional[dict] = None
+    types: Optional[dict] = None,
+    engine: Optional[str] = None
 ) -> pd.DataFrame:
     """
     Merge heating and ventilation Excel files based on room identification.
@@ -116,8 +129,9 @@ async def merge_heating_ventilation_excel(
     - Raumlüftung (ventilation data)
     
     Args:
-        heating_path (str): Path to the heating Excel file (.xlsm or .xlsx)
-        ventilation_path (str): Path to the ventilation Excel file (.xlsm or .xlsx)
+        heating_path (str | IO[bytes]): Path to the heating Excel file (.xlsm or .xlsx),
+            or a binary file object with its content (e.g. an in-memory upload)
+        ventilation_path (str | IO[bytes]): Path or binary file object of the ventilation Excel file
         header_row (Optional[int]): Row number containing the column headers (0-indexed). 
             If None and auto_detect_structure=True, will use AI to detect. Default is None.
         merge_keys (Optional[List[str]]): List of column names to use for merging.
@@ -129,6 +143,8 @@ async def merge_heating_ventilation_excel(
             - 'right': Keep all rooms from ventilation file
         auto_detect_structure (bool): If True, uses AI to detect Excel structure automatically.
             Handles title rows, merged cells, and inconsistent formatting. Default is True.
+        engine (Optional[str]): pandas Excel reader engine, e.g. 'calamine' for the Rust-based
+            reader (reads .xls, .xlsx and .xlsm). Default is None (pandas picks by file type).
     
     Returns:
         pd.DataFrame: Merged dataframe with columns from both heating and ventilation files.
@@ -165,19 +181,19 @@ async def merge_heating_ventilation_excel(
     # Auto-detect structure if requested
     if auto_detect_structure and header_row is None:
         print(f"   🔍 Auto-detecting Excel structure for heating file...")
-        df_heating_raw = pd.read_excel(heating_path, header=None)
+        df_heating_raw = await _read_excel(heating_path, header=None, engine=engine)
         heating_analysis = await analyze_excel(df_heating_raw)
         heating_header_row = heating_analysis.header_row_num
         heating_data_start = heating_analysis.data_start_row
         print(f"   ✓ Detected header at row {heating_header_row}, data starts at row {heating_data_start}")
         
         # Re-read with correct structure
-        df_heating = pd.read_excel(heating_path, header=heating_header_row, skiprows=None)
+        df_heating = await _read_excel(heating_path, header=heating_header_row, skiprows=None, engine=engine)
         df_heating = df_heating.iloc[heating_data_start - heating_header_row - 1:].reset_index(drop=True)
     else:
         # Use provided header_row or default to 5
         actual_header_row = header_row if header_row is not None else 5
-        df_heating = pd.read_excel(heating_path, header=actual_header_row)
+        df_heating = await _read_excel(heating_path, header=actual_header_row, engine=engine)
     
     print(f"   Shape: {df_heating.shape}")
     
@@ -186,19 +202,19 @@ async def merge_heating_ventilation_excel(
     # Auto-detect structure if requested
     if auto_detect_structure and header_row is None:
         print(f"   🔍 Auto-detecting Excel structure for ventilation file...")
-        df_ventilation_raw = pd.read_excel(ventilation_path, header=None)
+        df_ventilation_raw = await _read_excel(ventilation_path, header=None, engine=engine)
         ventilation_analysis = await analyze_excel(df_ventilation_raw)
         ventilation_header_row = ventilation_analysis.header_row_num
         ventilation_data_start = ventilation_analysis.data_start_row
         print(f"   ✓ Detected header at row {ventilation_header_row}, data starts at row {ventilation_data_start}")
         
         # Re-read with correct structure
-        df_ventilation = pd.read_excel(ventilation_path, header=ventilation_header_row, skiprows=None)
+        df_ventilation = await _read_excel(ventilation_path, header=ventilation_header_row, skiprows=None, engine=engine)
         df_ventilation = df_ventilation.iloc[ventilation_data_start - ventilation_header_row - 1:].reset_index(drop=True)
     else:
         # Use provided header_row or default to 5
         actual_header_row = header_row if header_row is not None else 5
-        df_ventilation = pd.read_excel(ventilation_path, header=actual_header_row)
+        df_ventilation = await _read_excel(ventilation_path, header=actual_header_row, engine=engine)
     
     print(f"   Shape: {df_ventilation.shape}")
     
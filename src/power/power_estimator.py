@@ -6,11 +6,43 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 import pandas as pd
 from pydantic import BaseModel
 from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from typing import Mapping
 import time
 
 # Load environment variables
 load_dotenv()
 
+POWER_DIR = Path(__file__).resolve().parent
+DEFAULT_CONTEXT_PATH = POWER_DIR / "context.json"
+DEFAULT_OUTPUT_PATH = POWER_DIR / "performance_table.xlsx"
+
+# Room type numbers ('Nummer Raumtyp') and their names
+ROOM_TYPES = MappingProxyType({
+    1: "Flex-/ Co-Work/",
+    2: "Einzel-/Zweierbüros",
+    3: "Technikum",
+    4: "Smart Farming",
+    5: "Robotik",
+    6: "Verkehrsflächen, Flure",
+    7: "Teeküchen",
+    8: "WCs",
+    9: "ELT-Zentrale",
+    10: "Putzmittel/ Lager",
+    11: "Lager innenliegend",
+    12: "TGA-Zentrale",
+    13: "Etagenverteiler",
+    14: "ELT-Schacht",
+    15: "Batterieräume",
+    16: "Drucker-/Kopierräume",
+    17: "Treppenhäuser/Magistrale",
+    18: "Schächte",
+    19: "Aufzüge",
+    20: "Seminarraum",
+    21: "Diele",
+})
+
 class RoomPowerEstimate(BaseModel):
     """Power estimates for a single room"""
     room_nr: str
@@ -36,6 +68,11 @@ class HistoricDataEntry(BaseModel):
     """Collection of room type mappings"""
     mappings: list[RoomTypeMapping]
 
+def valid_room_types(df: pd.DataFrame) -> list:
+    """Unique room type numbers in 'Nummer Raumtyp' (placeholders like '-' are skipped)"""
+    values = df['Nummer Raumtyp'].dropna().unique()
+    return [int(rt) for rt in values if isinstance(rt, (int, float)) and 0 <= rt < 100]
+
 async def generate_room_type_mapping(room_type_names, historic_data: dict) -> dict:
     """Generate a mapping for room type names to historic data keys using gemini."""
     print(f"\n🔍 Generating room type mapping for: {room_type_names}")
@@ -71,7 +108,19 @@ Examples:
     mapping_dict = {m.room_type_name: m.historic_key for m in response.mappings}
     return mapping_dict
 
-async def test_cost_analysis(df: pd.DataFrame, skip_structure_analysis: bool = False, types: dict[int, str] = None):
+@lru_cache(maxsize=8)
+def load_historic_data(context_path: Path) -> dict:
+    """Load historic power data (read from disk once per path; treat as read-only)"""
+    with open(context_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+async def test_cost_analysis(
+    df: pd.DataFrame,
+    skip_structure_analysis: bool = False,
+    types: Mapping[int, str] = ROOM_TYPES,
+    context_path: Path = DEFAULT_CONTEXT_PATH,
+    output_path: Path = DEFAULT_OUTPUT_PATH,
+):
     """
     Analyze room data and estimate power requirements per trade.
     
@@ -79,6 +128,9 @@ async def test_cost_analysis(df: pd.DataFrame, skip_structure_analysis: bool = F
         df: DataFrame containing room data
         skip_structure_analysis: If True, assumes df already has proper column names (from merge).
                                  If False, will analyze structure and extract headers from raw data.
+        types: Room type number to name mapping (defaults to ROOM_TYPES)
+        context_path: Historic power data (context.json), independent of the working directory
+        output_path: Where the performance table is written
     
     Returns:
         Dictionary mapping room numbers to power estimates
@@ -87,8 +139,7 @@ async def test_cost_analysis(df: pd.DataFrame, skip_structure_analysis: bool = F
     print(f"Column names: {list(df.columns[:10])}...")  # Show first 10 columns
 
     # Load historic data
-    with open("context.json", "r", encoding="utf-8") as f:
-        historic_data = json.load(f)
+    historic_data = load_historic_data(Path(context_path))
     
     # Initialize Google GenAI chat model with optimized settings
     llm = ChatGoogleGenerativeAI(
@@ -115,8 +166,7 @@ async def test_cost_analysis(df: pd.DataFrame, skip_structure_analysis: bool = F
         return {}
     
     # Collect all unique room types and prepare batch data
-    unique_room_types = df['Nummer Raumtyp'].dropna().unique()
-    unique_room_types = [int(rt) for rt in unique_room_types if isinstance(rt, (int, float)) and 0 <= rt < 100]
+    unique_room_types = valid_room_types(df)
     
     print(f"\n📊 Found {len(unique_room_types)} unique room types to process")
     print(f"   Room types: {sorted(unique_room_types)}")
@@ -229,8 +279,8 @@ async def test_cost_analysis(df: pd.DataFrame, skip_structure_analysis: bool = F
 
         # Save results to Excel
         output_df = pd.DataFrame.from_dict(power_estimates_results, orient='index')
-        output_df.to_excel(f"performance_table.xlsx", index_label="Raum-Nr.")
-        print(f"\n💾 Results saved to: performance_table.xlsx")
+        output_df.to_excel(output_path, index_label="Raum-Nr.")
+        print(f"\n💾 Results saved to: {output_path}")
         
         return power_estimates_results
         
@@ -242,30 +292,6 @@ if __name__ == "__main__":
     from merge_excel_files import merge_heating_ventilation_excel
     
     async def main():
-        types = {
-            1: "Flex-/ Co-Work/",
-            2: "Einzel-/Zweierbüros",
-            3: "Technikum",
-            4: "Smart Farming",
-            5: "Robotik",
-            6: "Verkehrsflächen, Flure",
-            7: "Teeküchen",
-            8: "WCs",
-            9: "ELT-Zentrale",
-            10: "Putzmittel/ Lager",
-            11: "Lager innenliegend",
-            12: "TGA-Zentrale",
-            13: "Etagenverteiler",
-            14: "ELT-Schacht",
-            15: "Batterieräume",
-            16: "Drucker-/Kopierräume",
-            17: "Treppenhäuser/Magistrale",
-            18: "Schächte",
-            19: "Aufzüge",
-            20: "Serminarraum",
-            21: "Diele"
-        }
-
         # Merge heating and ventilation data with AI-powered structure detection
         merged_df = await merge_heating_ventilation_excel(
             'data/p5-lp2-input-heizung.xlsm',
@@ -274,7 +300,7 @@ if __name__ == "__main__":
         )
         
         # Analyze the merged DataFrame (skip structure analysis since merge already has proper columns)
-        power_generated_results = await test_cost_analysis(merged_df, skip_structure_analysis=True, types=types)
+        power_generated_results = await test_cost_analysis(merged_df, skip_structure_analysis=True)
         
 
         # Add the power estimates back into the Excel file under the appropriate columns
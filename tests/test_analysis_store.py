@@ -0,0 +1,34 @@
+"""Size and age bounds of the in-memory analysis store"""
+
+import asyncio
+import time
+
+from src.api import AnalysisStore
+
+
+def test_size_bound_is_global_across_shards():
+    store = AnalysisStore(maxsize=4, ttl=60, shards=4)
+    ids = [f"analysis-{i}" for i in range(4 + 12)]
+    
+    async def save_all():
+        for analysis_id in ids:
+            await store.save(analysis_id, {"state": "completed"})
+            await store.set_progress(analysis_id, "step1", 100)
+        return [analysis_id for analysis_id in ids if await store.exists(analysis_id)]
+    
+    kept = asyncio.run(save_all())
+    
+    assert len({id(store._shard(analysis_id)[0]) for analysis_id in ids}) > 1
+    assert kept == ids[-4:]
+    assert asyncio.run(store.count()) == 4
+    assert asyncio.run(store.get_progress(ids[0])) is None
+
+
+def test_entries_expire_after_ttl():
+    store = AnalysisStore(maxsize=4, ttl=0.05, shards=4)
+    asyncio.run(store.save("old", {"state": "completed"}))
+    time.sleep(0.1)
+    asyncio.run(store.save("new", {"state": "completed"}))
+    
+    assert asyncio.run(store.get("old")) is None
+    assert asyncio.run(store.get("new"))["state"] == "completed"
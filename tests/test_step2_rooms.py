@@ -0,0 +1,49 @@
+"""Step 2 on uploads whose room numbers are all empty"""
+
+import asyncio
+
+import numpy as np
+import pandas as pd
+
+import src.api as api
+
+
+def test_empty_room_numbers_keep_key_and_area_columns():
+    df = pd.DataFrame({
+        'Raum-Nr.': [np.nan, np.nan],
+        'Raum-Bezeichnung': ['Büro 1', 'Büro 2'],
+        'Nummer Raumtyp': [1, 1],
+        'Fläche': [np.nan, np.nan],
+        'Bemerkung': [None, None],
+    })
+    
+    slim_df = api.slim_for_step2(df)
+    
+    assert list(slim_df.columns) == ['Raum-Nr.', 'Raum-Bezeichnung', 'Nummer Raumtyp', 'Fläche']
+
+
+def test_step2_with_empty_room_numbers_returns_a_result(monkeypatch):
+    df = pd.DataFrame({
+        'Raum-Nr.': [np.nan, np.nan],
+        'Raum-Bezeichnung': ['Büro 1', 'Büro 2'],
+        'Nummer Raumtyp': [1, 1],
+        'Fläche': [20.0, 15.0],
+    })
+    
+    async def estimates_by_room_name(*args, **kwargs):
+        # The model falls back to Raum-Bezeichnung when Raum-Nr. is empty
+        return {
+            name: {'heating_W_per_m2': 50.0, 'cooling_W_per_m2': 30.0, 'room_type': 1}
+            for name in df['Raum-Bezeichnung']
+        }
+    
+    monkeypatch.setattr(api, 'test_cost_analysis', estimates_by_room_name)
+    analysis_data = {
+        'slim_df_parquet': api.df_to_parquet_bytes(api.slim_for_step2(df)),
+        'area_col': 'Fläche',
+    }
+    
+    response = asyncio.run(api.run_step2('empty-room-numbers', analysis_data))
+    
+    assert response['details']['heatingPowerKw'] == 0
+    assert response['details']['breakdownByRoomType'] == []
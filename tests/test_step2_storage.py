@@ -0,0 +1,40 @@
+"""Round-trip checks for the Parquet frames stored between step 1 and step 2"""
+
+import numpy as np
+import pandas as pd
+
+from src.api import df_to_parquet_bytes, parquet_bytes_to_df, slim_for_step2
+from src.power.power_estimator import valid_room_types
+
+
+def round_trip(df: pd.DataFrame) -> pd.DataFrame:
+    return parquet_bytes_to_df(df_to_parquet_bytes(slim_for_step2(df)))
+
+
+def test_placeholder_room_type_keeps_integer_room_types():
+    df = pd.DataFrame({
+        'Raum-Nr.': [101, 102, '1.03a'],
+        'Nummer Raumtyp': [1, 2, '-'],
+        'Fläche': [20.5, 18.0, np.nan],
+        'Bemerkung': ['x', 3, None],
+    })
+    
+    stored = round_trip(df)
+    
+    assert valid_room_types(stored) == [1, 2]
+    assert stored['Nummer Raumtyp'].tolist() == [1, 2, '-']
+    assert stored['Raum-Nr.'].tolist() == [101, 102, '1.03a']
+    assert list(stored.columns) == list(df.columns)
+
+
+def test_clean_key_columns_keep_their_dtypes():
+    df = pd.DataFrame({
+        'Raum-Nr.': ['A.01', 'A.02'],
+        'Nummer Raumtyp': [1.0, np.nan],
+    })
+    
+    stored = round_trip(df)
+    
+    assert stored['Nummer Raumtyp'].dtype == np.float64
+    assert valid_room_types(stored) == [1]
+    assert stored['Raum-Nr.'].tolist() == ['A.01', 'A.02']